@@ -1,18 +1,20 @@
 from annoy import AnnoyIndex
 import json
-from time import time
+from time import time, sleep, monotonic
 from typing import Dict, List, Tuple, Union, Optional
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import s3fs
 import datetime
 import tarfile
-import struct
+import tempfile
 import os
+import threading
+from collections import OrderedDict
+import numpy as np
 from pathlib import Path
-import logging
-
-logging.basicConfig(level=logging.INFO)
 
 S3_URI_PREFIX = 's3://'
 
@@ -25,20 +27,110 @@ ANN_META_KEY = 'metadata.json'
 TIMESTAMP_LOCAL_KEY = 'timestamp.txt'
 # DYNAMO_ID = 'variant_id'
 DYNAMO_KEY = 'repr'
+DYNAMO_BATCH_SZ = 100  # max keys per BatchGetItem
+DYNAMO_BATCH_RETRIES = 5
+DYNAMO_BACKOFF_BASE = 0.05  # seconds
+DYNAMO_CACHE_SZ = 65536  # max OOI embeddings kept in memory
+DYNAMO_CACHE_TTL = 3600  # seconds (default index reload check interval)
+DYNAMO_MISS_TTL = 60  # seconds; ids missing now may be written soon
 DTYPE_FMT = 'f'  # float32 struct
 DTYPE_SZ = 4  # float32 is 4 bytes
+DTYPE_NP = np.float32
 SEED = 322
 
 PathType = Union[Path, str]
 
 s3 = s3fs.S3FileSystem()
-dynamodb = boto3.resource('dynamodb')
+# Shared across resources so OOI lookups reuse warm connections
+# from the (urllib3) connection pool
+DYNAMO_CONFIG = Config(
+    max_pool_connections=64,
+    connect_timeout=0.1,
+    read_timeout=0.25,
+    retries={'max_attempts': 2, 'mode': 'adaptive'},
+)
+dynamodb = boto3.resource('dynamodb', config=DYNAMO_CONFIG)
+s3_client = boto3.client('s3')
+# Parallel ranged GETs for pulling (large) index tarballs
+S3_TRANSFER_CONFIG = TransferConfig(
+    max_concurrency=16,
+    multipart_chunksize=8 * 1024 * 1024,
+)
+
+
+class LRUCache(object):
+    """Minimal thread-safe LRU mapping
+    whose entries expire `ttl` seconds after being set
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None,
+                 timer=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._d = OrderedDict()  # key -> (expiry or None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._d.get(key)
+            if entry is None:
+                return default
+            expiry, value = entry
+            if expiry is not None and expiry <= self.timer():
+                del self._d[key]
+                return default
+            self._d.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        """Caches `value` for `ttl` seconds (defaults to `self.ttl`;
+        never expires if both are None)
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expiry = None if ttl is None else self.timer() + ttl
+        with self._lock:
+            self._d[key] = (expiry, value)
+            self._d.move_to_end(key)
+            if len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        return len(self._d)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+
+class DynamoLookupError(Exception):
+    """Dynamo couldn't be read (as opposed to the id not existing)"""
+
+
+class DynamoValidationError(DynamoLookupError):
+    """Dynamo rejected the request itself
+    (ex. an int id for a string-keyed table), so retrying won't help
+    """
+
+
+# (table name, repr key, id) -> emb (or `DYNAMO_MISS` if not in the table)
+dynamo_emb_cache = LRUCache(DYNAMO_CACHE_SZ, ttl=DYNAMO_CACHE_TTL)
+DYNAMO_MISS = object()
 
 
 def is_s3_path(path: PathType):
     return str(path).startswith(S3_URI_PREFIX)
 
 
+def split_s3_path(path: PathType) -> Tuple[str, str]:
+    """ex) 's3://my-bucket/ann/a.tar.gz' -> ('my-bucket', 'ann/a.tar.gz')"""
+    bucket, _, key = str(path)[len(S3_URI_PREFIX):].partition('/')
+    return bucket, key
+
+
 def load_fallback_map(path_fallback_map: PathType) -> Dict[str, str]:
     if is_s3_path(path_fallback_map):
         open_fn = s3.open
@@ -70,6 +162,18 @@ def needs_reload(path_tar: PathType,
             return mtime > ts_read_utc
 
 
+def load_ts_read_utc(path_local_ts_read: PathType
+                     ) -> Optional[datetime.datetime]:
+    """Reads the timestamp written when the index was last extracted
+    (None if it hasn't been extracted yet)
+    """
+    if not Path(path_local_ts_read).exists():
+        return None
+    with open(path_local_ts_read, 'r') as f:
+        return datetime.datetime.fromtimestamp(
+            int(f.read().strip()), tz=datetime.timezone.utc)
+
+
 def load_via_tar(path_tar: PathType,
                  path_extract: PathType,
                  reload: bool = True):
@@ -79,12 +183,29 @@ def load_via_tar(path_tar: PathType,
         # Note: `fromisoformat` only in Py3.7
         # ts_read = datetime.datetime.utcnow().isoformat()
         ts_read = int(time())
-        if is_s3_path(path_tar):
-            ann_tar = tarfile.open(fileobj=s3.open(path_tar, 'rb'))
-        else:
-            ann_tar = tarfile.open(fileobj=open(path_tar, 'rb'))
+        path_extract = Path(path_extract)
+        path_extract.mkdir(parents=True, exist_ok=True)
+        # Extract into a staging dir and swap the files in afterwards,
+        # so queries keep using the current index while this runs
+        with tempfile.TemporaryDirectory(
+                dir=path_extract.parent) as path_staging:
+            if is_s3_path(path_tar):
+                # Multipart download writes chunks out of order,
+                # so land it in a tmp file and stream-extract from there
+                bucket, key = split_s3_path(path_tar)
+                with tempfile.TemporaryFile(dir=path_staging) as f:
+                    s3_client.download_fileobj(
+                        bucket, key, f, Config=S3_TRANSFER_CONFIG)
+                    f.seek(0)
+                    extract_tar(f, path_staging)
+            else:
+                with open(path_tar, 'rb') as f:
+                    extract_tar(f, path_staging)
 
-        ann_tar.extractall(path_extract)
+            # `os.replace` is atomic and leaves the old (unlinked) inode
+            # alive for an index that is still mmap'd
+            for path_member in Path(path_staging).iterdir():
+                os.replace(path_member, path_extract / path_member.name)
 
         with open(path_local_ts_read, 'w') as f:
             f.write(str(ts_read))
@@ -96,6 +217,12 @@ def load_via_tar(path_tar: PathType,
     return ann_index_path, ann_ids, ann_ids_d, path_local_ts_read, meta_d
 
 
+def extract_tar(fileobj, path_extract: PathType):
+    """Single sequential pass over the (maybe compressed) tar stream"""
+    with tarfile.open(fileobj=fileobj, mode='r|*') as ann_tar:
+        ann_tar.extractall(path_extract)
+
+
 def load_ann_meta(path_meta: PathType) -> Dict:
     meta_d = json.load(open(path_meta, 'r'))
     return meta_d
@@ -105,7 +232,7 @@ def load_index(path_index: PathType,
                meta_d: Dict) \
         -> AnnoyIndex:
     """ We rely on ANNOY's usage of mmap to be fast loading
-    (fast enough that we can load it on every single call)
+    (the index is loaded once per (re)load and cached on the resource)
     """
     n_dim = meta_d['n_dim']
     metric = meta_d['metric']
@@ -118,7 +245,7 @@ def load_index(path_index: PathType,
     return u
 
 
-def load_ids(path_ids: PathType) -> Tuple[List[str], Dict[str, int]]:
+def load_ids(path_ids: PathType) -> Tuple[np.ndarray, Dict[str, int]]:
     if is_s3_path(path_ids):
         open_fn = s3.open
     else:
@@ -127,19 +254,93 @@ def load_ids(path_ids: PathType) -> Tuple[List[str], Dict[str, int]]:
     ids = [s.decode('utf-8') for s in
            open_fn(path_ids, 'rb').read().splitlines()]
     ids_d = dict(zip(ids, range(len(ids))))
-    return ids, ids_d
+    # object array shares the str objects with `ids_d` (no second copy)
+    # and supports fancy indexing by ANN output inds
+    return np.asarray(ids, dtype=object), ids_d
 
 
 def get_dynamo_emb(table,
                    variant_id,
                    repr_key=DYNAMO_KEY):
+    """Single embedding (None if missing or dynamo can't be read)"""
     try:
-        id_key = table.key_schema[0]['AttributeName']
-        response = table.get_item(Key={id_key: variant_id})
-        item = response['Item']
-    except (ClientError, KeyError) as e:
+        return get_dynamo_embs(table, [variant_id], repr_key).get(variant_id)
+    except DynamoLookupError:
         return None
-    else:
-        b_str = item[repr_key].value
-        emb = struct.unpack(DTYPE_FMT * (len(b_str) // DTYPE_SZ), b_str)
-    return emb
+
+
+def get_dynamo_embs(table,
+                    variant_ids: List,
+                    repr_key=DYNAMO_KEY,
+                    max_retries=DYNAMO_BATCH_RETRIES) -> Dict:
+    """Fetches many embeddings with `BatchGetItem`
+    (up to `DYNAMO_BATCH_SZ` keys per round-trip).
+    Hot ids (and ids recently found missing) are served from
+    `dynamo_emb_cache` without a round-trip.
+
+    Returns: Dict of id -> float32 emb (missing ids are omitted)
+
+    Raises: `DynamoLookupError` if dynamo errors or times out or keys
+        are still unprocessed (throttled) after `max_retries` retries,
+        `DynamoValidationError` if dynamo rejects the keys
+    """
+    embs = {}
+    variant_ids_miss = []
+    # BatchGetItem rejects duplicate keys within a request
+    for v in dict.fromkeys(variant_ids):
+        emb = dynamo_emb_cache.get((table.name, repr_key, v))
+        if emb is None:
+            variant_ids_miss.append(v)
+        elif emb is not DYNAMO_MISS:
+            embs[v] = emb
+    variant_ids = variant_ids_miss
+    if not variant_ids:
+        return embs
+
+    id_key = table.key_schema[0]['AttributeName']
+    for i in range(0, len(variant_ids), DYNAMO_BATCH_SZ):
+        keys = [{id_key: v} for v in variant_ids[i:i + DYNAMO_BATCH_SZ]]
+        request_items = {table.name: {'Keys': keys,
+                                      'ProjectionExpression': '#k, #r',
+                                      'ExpressionAttributeNames': {
+                                          '#k': id_key, '#r': repr_key}}}
+        for n_try in range(max_retries + 1):
+            try:
+                response = dynamodb.batch_get_item(
+                    RequestItems=request_items)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') \
+                        == 'ValidationException':
+                    raise DynamoValidationError(str(e)) from e
+                raise DynamoLookupError(str(e)) from e
+            except BotoCoreError as e:
+                # ex) connect/read timeouts, endpoint connection errors
+                raise DynamoLookupError(str(e)) from e
+
+            ids_pending = {
+                k[id_key] for k in request_items[table.name]['Keys']}
+            for item in response['Responses'].get(table.name, []):
+                emb = np.frombuffer(item[repr_key].value, dtype=DTYPE_NP)
+                embs[item[id_key]] = emb
+                dynamo_emb_cache[(table.name, repr_key, item[id_key])] = emb
+                ids_pending.discard(item[id_key])
+
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                ids_pending.difference_update(
+                    k[id_key] for k in request_items[table.name]['Keys'])
+            # Neither returned nor unprocessed: not in the table
+            for v in ids_pending:
+                dynamo_emb_cache.set((table.name, repr_key, v), DYNAMO_MISS,
+                                     ttl=DYNAMO_MISS_TTL)
+
+            if not request_items:
+                break
+            if n_try < max_retries:
+                # Exponential backoff on throttled keys
+                sleep(DYNAMO_BACKOFF_BASE * 2 ** n_try)
+        else:
+            raise DynamoLookupError(
+                f'{len(request_items[table.name]["Keys"])} keys still '
+                f'unprocessed after {max_retries} retries')
+    return embs
@@ -1,16 +1,26 @@
 import falcon
 from annoy import AnnoyIndex
 import json
+import ujson
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from time import time
-from typing import Dict, List, Union, Any, Optional
-import boto3
+from typing import Dict, List, Union, Any, Optional, NamedTuple
 import s3fs
 import datetime
 from pathlib import Path
-from ..io import needs_reload, load_via_tar, load_index, get_dynamo_emb
+from ..io import (
+    needs_reload, load_via_tar, load_index, get_dynamo_emb, get_dynamo_embs,
+    load_ts_read_utc, dynamodb, dynamo_emb_cache, DynamoLookupError,
+    DynamoValidationError)
 import logging
+try:
+    from gevent import get_hub, monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 S3_URI_PREFIX = 's3://'
 
@@ -25,37 +35,47 @@ DYNAMO_ID = 'variant_id'
 DYNAMO_KEY = 'repr'
 DTYPE_FMT = 'f'  # float32 struct
 SEED = 322
+OCTET_STREAM = 'application/octet-stream'
+# ujson writes doubles with a fixed number of decimals (10 by default);
+# 15 is its max and keeps small dists/scores' significant digits
+UJSON_DOUBLE_PRECISION = 15
 
 PathType = Union[Path, str]
 
 s3 = s3fs.S3FileSystem()
-dynamodb = boto3.resource('dynamodb')
+# Shared by all indexes (threads are only started as needed)
+query_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
 
 
-class Rec(object):
+class QueryNotFoundError(Exception):
+    """Query id is not in the index and has no ooi embedding"""
 
-    def __init__(self, id_, dist=None):
-        self.id_ = id_
-        self.dist = dist
 
-    @property
-    def score(self):
-        """
-        NOTE: This is only for ANNOY's angular distance (which is [0, 2])
-        https://github.com/spotify/annoy/issues/149"""
+class InvalidPayloadError(ValueError):
+    """Query payload is malformed (a client error)"""
 
-        if self.dist is None:
-            return None
-        else:
-            return 1. - self.dist / 2.
 
-    def to_dict(self, incl_dist=True, incl_score=True):
-        d = {'id': self.id_}
-        if incl_dist:
-            d['dist'] = self.dist
-        if incl_score:
-            d['score'] = self.score
-        return d
+class QueryOpts(NamedTuple):
+    k: int
+    incl_dist: bool
+    incl_score: bool
+    # whether ANNOY needs to return distances (for dist, score or thresh)
+    include_distances: bool
+    # `thresh_score` converted to a distance (None if no threshold)
+    dist_thresh: Optional[float]
+
+
+class LoadedIndex(NamedTuple):
+    """Everything read from one (re)load of an index
+
+    Swapped as a whole on reload; a query reads it once and passes
+    it down, so it never maps one load's inds through another's ids
+    """
+    ann_index: AnnoyIndex
+    ids: np.ndarray
+    ids_d: Dict[Any, int]
+    ann_meta_d: Dict[str, Any]
+    path_index_local: PathType
 
 
 class ANNResource(object):
@@ -75,15 +95,12 @@ class ANNResource(object):
         self.ooi_dynamo_table = ooi_dynamo_table
         self.name = name
 
-        # not multithread-safe to do this with multiple indexes per server
-        # self.index: AnnoyIndex = None
-
-        self.path_index_local: str = None
-        self.ids: List[Any] = None
-        self.ids_d: Dict[Any, int] = None
-        self.ann_meta_d: Dict[str, Any] = None
+        self.loaded: LoadedIndex = None
         self.fallback_parent: 'ANNResource' = None
         self.ooi_ann: 'ANNResource' = None
+        # Cached; only changes when the index is (re)loaded
+        self._ts_read_utc: Optional[datetime.datetime] = load_ts_read_utc(
+            self.path_extract / TIMESTAMP_LOCAL_KEY)
 
         # There is a chance that the ANN is already downloaded in tmp
         self.load(reload=needs_reload(self.path_tar, self.ts_read_utc))
@@ -95,14 +112,7 @@ class ANNResource(object):
 
     @property
     def ts_read_utc(self) -> Optional[datetime.datetime]:
-        path_local_ts_read = self.path_extract / TIMESTAMP_LOCAL_KEY
-        if not Path(path_local_ts_read).exists():
-            local_mtime = None
-        else:
-            local_mtime = datetime.datetime.fromtimestamp(
-                int(open(path_local_ts_read, 'r').read().strip()),
-                tz=datetime.timezone.utc)
-        return local_mtime
+        return self._ts_read_utc
 
     @property
     def needs_reload(self):
@@ -110,118 +120,313 @@ class ANNResource(object):
 
     @property
     def ann_index(self) -> AnnoyIndex:
-        return load_index(self.path_index_local, self.ann_meta_d)
+        return self.loaded.ann_index
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.loaded.ids
+
+    @property
+    def ids_d(self) -> Dict[Any, int]:
+        return self.loaded.ids_d
+
+    @property
+    def ann_meta_d(self) -> Dict[str, Any]:
+        return self.loaded.ann_meta_d
+
+    @property
+    def path_index_local(self) -> PathType:
+        return self.loaded.path_index_local
 
     def load(self, path_tar: str = None, reload: bool = True):
         path_tar = path_tar or self.path_tar
         tic = time()
-        logging.info(f'Loading: {path_tar}')
-        self.path_index_local, self.ids, self.ids_d, \
-            ts_read, self.ann_meta_d = \
+        logger.info('Loading: %s', path_tar)
+        path_index_local, ids, ids_d, path_local_ts_read, ann_meta_d = \
             load_via_tar(path_tar, self.path_extract, reload)
-        logging.info(f'...Done Loading! [{time() - tic} s]')
+        # Swap in one assignment, after the slow download/extract/load,
+        # so queries never see a missing or half-extracted index
+        self.loaded = LoadedIndex(
+            load_index(path_index_local, ann_meta_d), ids, ids_d,
+            ann_meta_d, path_index_local)
+        self._ts_read_utc = load_ts_read_utc(path_local_ts_read)
+        logger.info('...Done Loading! [%s s]', time() - tic)
 
     def maybe_reload(self):
         if self.needs_reload:
-            logging.info(f'Reloading [{self.path_tar}] due to staleness')
+            logger.info('Reloading [%s] due to staleness', self.path_tar)
+            dynamo_emb_cache.clear()
             self.load(reload=True)
 
-    def recs_via_ann_out(self, ann_out, incl_dist) -> List[Rec]:
-        """Convenience fn for constructing rec objects
+    def recs_via_ann_out(self, ann_out, incl_dist, incl_score=True,
+                         loaded: LoadedIndex = None) -> List[Dict]:
+        """Convenience fn for constructing rec dicts
         from ann output
-        """
-        if incl_dist:
-            inds, dists = ann_out
-        else:
-            inds = ann_out
-            dists = [None] * len(inds)
-        ids = [self.ids[ind] for ind in inds]
-        neighbors = [
-            Rec(id_, dist) for id_, dist in zip(ids, dists)
-        ]
-        return neighbors
 
-    def nn_from_emb(self, q_emb, k: int, ann_index=None, incl_dist=False
-                    ) -> List[Rec]:
-        ann_index = ann_index or self.ann_index
-        ann_out = ann_index.get_nns_by_vector(
-            q_emb, k, include_distances=incl_dist)
-        neighbors = self.recs_via_ann_out(ann_out, incl_dist)
+        NOTE: score is only for ANNOY's angular distance (which is [0, 2])
+        https://github.com/spotify/annoy/issues/149
+        """
+        ids = (loaded or self.loaded).ids
+        if not incl_dist:
+            # Common case: just the neighbor ids
+            return [{'id': id_} for id_ in
+                    ids[np.asarray(ann_out, dtype=np.int64)].tolist()]
+
+        inds, dists = ann_out
+        ids = ids[np.asarray(inds, dtype=np.int64)].tolist()
+        if not incl_score:
+            # Distances only needed for `dist` and/or `thresh_score`
+            # (thresholds compare distances directly)
+            return [{'id': id_, 'dist': d} for id_, d in zip(ids, dists)]
+        return [{'id': id_, 'dist': d, 'score': 1. - d * 0.5}
+                for id_, d in zip(ids, dists)]
+
+    def nn_from_emb(self, q_emb, k: int, loaded: LoadedIndex = None,
+                    incl_dist=False, incl_score=True) -> List[Dict]:
+        loaded = loaded or self.loaded
+        if isinstance(q_emb, np.ndarray):
+            # ANNOY's binding reads the query item by item as a sequence;
+            # python floats convert much faster than numpy scalars
+            q_emb = q_emb.tolist()
+        try:
+            ann_out = loaded.ann_index.get_nns_by_vector(
+                q_emb, k, include_distances=incl_dist)
+        except TypeError as e:
+            # ex) a non-number in the embedding
+            raise InvalidPayloadError(f'Invalid embedding: {e}')
+        neighbors = self.recs_via_ann_out(
+            ann_out, incl_dist, incl_score, loaded=loaded)
         return neighbors
 
-    def nn_from_id(self, q_id: str, k: int, ann_index=None, incl_dist=False):
-        ann_index = ann_index or self.ann_index
-        if q_id in self.ids_d:
-            q_ind = self.ids_d[q_id]
+    def nn_from_id(self, q_id: str, k: int, loaded: LoadedIndex = None,
+                   incl_dist=False, ooi_emb=None, incl_score=True):
+        """
+        Args:
+            ooi_emb: pre-fetched embedding for an out of index `q_id`
+                (skips the per-id ooi lookup)
+        """
+        loaded = loaded or self.loaded
+        q_ind = loaded.ids_d.get(q_id)
+        if q_ind is not None:
             # Note: if id in index, query 1 more than you need and discard 1st
 
-            ann_out = ann_index.get_nns_by_item(
+            ann_out = loaded.ann_index.get_nns_by_item(
                 q_ind, k + 1, include_distances=incl_dist)
-            neighbors = self.recs_via_ann_out(ann_out, incl_dist)
-
-        elif self.ooi_dynamo_table is not None:
+            neighbors = self.recs_via_ann_out(
+                ann_out, incl_dist, incl_score, loaded=loaded)
+            neighbors = [n for n in neighbors if n['id'] != q_id]
+        else:
             # Need to look up the vector and query by vector
-            q_emb = get_dynamo_emb(self.ooi_dynamo_table, q_id)
+            # (Q is ooi so it can't be among its own neighbors)
+            q_emb = ooi_emb if ooi_emb is not None \
+                else self.get_ooi_vector(q_id)
+            neighbors = self.nn_from_emb(
+                q_emb, k, loaded=loaded, incl_dist=incl_dist,
+                incl_score=incl_score)
+
+        return neighbors
+
+    def get_ooi_vector(self, q_id):
+        """Vector for an out of index `q_id`
+        (raises `QueryNotFoundError` if it can't be found)
+        """
+        if self.ooi_dynamo_table is not None:
+            # Note: `DynamoLookupError` (dynamo unavailable) propagates
+            q_emb = get_dynamo_embs(self.ooi_dynamo_table, [q_id]).get(q_id)
             if q_emb is None:
-                raise Exception(
+                raise QueryNotFoundError(
                     'Q is ooi and doesnt exist in the ooi dynamo table')
-            neighbors = self.nn_from_emb(
-                q_emb, k, ann_index=ann_index, incl_dist=incl_dist)
         elif self.ooi_ann is not None:
-            # Need to look up the vector and query by vector
             q_emb = self.ooi_ann.get_vector(q_id)
             if q_emb is None:
-                raise Exception(
+                raise QueryNotFoundError(
                     'Q is ooi and doesnt exist in the ooi ann')
-            neighbors = self.nn_from_emb(
-                q_emb, k, ann_index=ann_index, incl_dist=incl_dist)
         else:
             # TODO: there's a chance Q is in the fallback parent index
             # TODO: depending on how the indexes were created
-            raise Exception('Q is ooi and no ooi dynamo table was set')
-
-        neighbors = [n for n in neighbors if n.id_ != q_id]
-
-        return neighbors
+            raise QueryNotFoundError(
+                'Q is ooi and no ooi dynamo table was set')
+        return q_emb
 
-    def nn_from_payload(self, payload: Dict) -> List[Rec]:
+    @staticmethod
+    def parse_query_opts(payload: Dict) -> QueryOpts:
+        """Parses the query options shared by single and batched payloads"""
+        if not isinstance(payload, dict):
+            raise InvalidPayloadError('Payload must be a JSON object')
         # TODO: parse and use `search_k`
-        k = payload['k']
-        incl_dist = payload.get('incl_dist') or False
+        k = payload.get('k')
+        if not isinstance(k, int) or isinstance(k, bool) or k <= 0:
+            raise InvalidPayloadError('`k` must be a positive integer')
+        incl_dist = bool(payload.get('incl_dist')) or False
         incl_score = bool(payload.get('incl_score')) or False
         thresh_score = payload.get('thresh_score')
-        thresh_score = float(thresh_score) if thresh_score else False
+        try:
+            thresh_score = float(thresh_score) if thresh_score else False
+        except (TypeError, ValueError):
+            raise InvalidPayloadError('`thresh_score` must be a number')
         include_distances = bool(incl_dist or incl_score or thresh_score)
-
+        dist_thresh = score_to_dist(thresh_score) if thresh_score else None
+        return QueryOpts(k, incl_dist, incl_score,
+                         include_distances, dist_thresh)
+
+    def nn_from_query(self, payload: Dict, opts: QueryOpts,
+                      loaded: LoadedIndex = None, ooi_emb=None
+                      ) -> List[Dict]:
+        """Neighbors for a single query (`id` or `emb` in payload)
+        with options already parsed
+        """
         if 'id' in payload:
             q_id = payload['id']
-            neighbors = self.nn_from_id(
-                q_id, k, incl_dist=include_distances)
+            q_emb = ooi_emb
         elif 'emb' in payload:
+            q_id = None
             q_emb = payload['emb']
+        else:
+            raise InvalidPayloadError('Payload must contain `id` or `emb`')
+
+        return self._nn(q_id, q_emb, opts, set(), loaded=loaded)
+
+    def _nn(self, q_id, q_emb, opts: QueryOpts, seen_ids: set,
+            loaded: LoadedIndex = None) -> List[Dict]:
+        """Neighbors for a query id and/or its already resolved embedding,
+        topped up from the fallback parent if there aren't enough
+
+        Args:
+            q_id: query id (None if querying by embedding only)
+            q_emb: query embedding if already resolved (else None)
+            seen_ids: neighbor ids already returned by child indexes
+        """
+        k = opts.k
+        # Over-fetch by the ids filtered out below: children are usually
+        # subsets of their parents, so these are often the top neighbors
+        k_fetch = k + len(seen_ids)
+        loaded = loaded or self.loaded
+        if q_id is None:
             neighbors = self.nn_from_emb(
-                q_emb, k, incl_dist=include_distances)
+                q_emb, k_fetch, loaded=loaded,
+                incl_dist=opts.include_distances, incl_score=opts.incl_score)
         else:
-            raise Exception('Payload must contain `id` or `emb`')
+            if q_emb is None and q_id not in loaded.ids_d:
+                # Resolve once here so fallback parents can reuse it
+                q_emb = self.get_ooi_vector(q_id)
+            neighbors = self.nn_from_id(
+                q_id, k_fetch, loaded=loaded,
+                incl_dist=opts.include_distances, ooi_emb=q_emb,
+                incl_score=opts.incl_score)
+
+        if seen_ids:
+            neighbors = [n for n in neighbors if n['id'] not in seen_ids]
+        # Threshold before marking ids as seen, so parents can still
+        # return neighbors this index dropped
+        if opts.dist_thresh is not None:
+            neighbors = truncate_by_dist(neighbors, opts.dist_thresh)
 
         # Fallback lookup if not enough neighbors
-        # TODO: there are some duplicated overheads by calling this
+        neighbors_fallback = []
         if (len(neighbors) < k) and (self.fallback_parent is not None):
-            neighbors_fallback = self.fallback_parent.nn_from_payload(
-                {**payload, **{'k': k - len(neighbors)}}
-            )
-            neighbors += neighbors_fallback
+            if q_emb is None and q_id is not None:
+                # Saves parents (that don't have Q) an OOI lookup
+                q_emb = loaded.ann_index.get_item_vector(
+                    loaded.ids_d[q_id])
+            # Note: the parent applies the threshold to its own neighbors
+            neighbors_fallback = self.fallback_parent._nn(
+                q_id, q_emb, opts._replace(k=k - len(neighbors)),
+                seen_ids.union(n['id'] for n in neighbors))
+
+        return (neighbors + neighbors_fallback)[:k]
+
+    def nn_from_payload(self, payload: Dict, opts: QueryOpts = None
+                        ) -> List[Dict]:
+        opts = opts or self.parse_query_opts(payload)
+        loaded = self.loaded
+        if 'id' in payload:
+            validate_id(payload['id'])
+        elif 'emb' in payload:
+            self.validate_emb(payload['emb'], loaded=loaded)
+        return self.nn_from_query(payload, opts, loaded=loaded)
 
-        if thresh_score:
-            neighbors = [n for n in neighbors if n.score > thresh_score]
+    def validate_emb(self, q_emb, loaded: LoadedIndex = None):
+        """Raises `InvalidPayloadError` unless `q_emb` is a list
+        of `n_dim` items (ANNOY would fail on it)
 
-        return neighbors[:k]
+        Items are left to ANNOY (non-numbers raise a `TypeError`
+        there) rather than checked one by one on the hot path
+        """
+        n_dim = (loaded or self.loaded).ann_meta_d['n_dim']
+        if not (isinstance(q_emb, list) and len(q_emb) == n_dim):
+            raise InvalidPayloadError(
+                f'`emb` must be a list of {n_dim} numbers')
+
+    def nn_from_payload_batch(self, payload: Dict, opts: QueryOpts = None
+                              ) -> List[List[Dict]]:
+        """Neighbors for many queries (`ids` or `embs` in payload)
+        in one request. Options are parsed once and every query
+        shares the same index reference.
+        Queries that can't be found get no neighbors.
+        """
+        opts = opts or self.parse_query_opts(payload)
+        # All threads share the one (mmap'd) index
+        loaded = self.loaded
+
+        if 'ids' in payload:
+            q_l = payload['ids']
+            if not isinstance(q_l, list):
+                raise InvalidPayloadError('`ids` must be a list')
+            for q_id in q_l:
+                validate_id(q_id)
+            ooi_embs = self.get_ooi_embs(q_l, loaded.ids_d)
+            # (id, emb) per query; emb is None for in-index ids
+            queries = [(q_id, ooi_embs.get(q_id)) for q_id in q_l]
+        elif 'embs' in payload:
+            q_l = payload['embs']
+            if not isinstance(q_l, list):
+                raise InvalidPayloadError('`embs` must be a list')
+            # Validate every query up front; the (python float) lists are
+            # already what ANNOY's binding reads fastest
+            for q_emb in q_l:
+                self.validate_emb(q_emb, loaded=loaded)
+            queries = [(None, q_emb) for q_emb in q_l]
+        else:
+            raise InvalidPayloadError(
+                'Batch payload must contain `ids` or `embs`')
+
+        def nn_single(query):
+            # May run on a native thread, so it must not do lookups
+            # (they take gevent locks and sockets): every embedding
+            # was resolved above, in the calling greenlet
+            q_id, q_emb = query
+            if q_emb is None and q_id not in loaded.ids_d:
+                # OOI id that couldn't be found
+                return []
+            return self._nn(q_id, q_emb, opts, set(), loaded=loaded)
+
+        if len(queries) <= 1:
+            return [nn_single(query) for query in queries]
+        return map_native_threads(nn_single, queries)
+
+    def get_ooi_embs(self, q_ids: List[Any], ids_d: Dict[Any, int]
+                     ) -> Dict[Any, Any]:
+        """Fetches out of index embeddings for many ids
+        in as few dynamo round-trips as possible
+        (ids that can't be found are left out)
+        """
+        ooi_ids = [q_id for q_id in q_ids if q_id not in ids_d]
+        if not ooi_ids:
+            return {}
+        if self.ooi_dynamo_table is not None:
+            return get_dynamo_embs(self.ooi_dynamo_table, ooi_ids)
+        if self.ooi_ann is not None:
+            ooi_embs = {q_id: self.ooi_ann.get_vector(q_id)
+                        for q_id in ooi_ids}
+            return {q_id: q_emb for q_id, q_emb in ooi_embs.items()
+                    if q_emb is not None}
+        return {}
 
     def get_vector(self, q_id):
-        if q_id in self.ids_d:
-            q_ind = self.ids_d[q_id]
-            ann_index = self.ann_index
-            q_emb = ann_index.get_item_vector(q_ind)
+        loaded = self.loaded
+        q_ind = loaded.ids_d.get(q_id)
+        if q_ind is not None:
+            q_emb = loaded.ann_index.get_item_vector(q_ind)
         elif self.ooi_dynamo_table is not None:
             q_emb = get_dynamo_emb(self.ooi_dynamo_table, q_id)
         elif self.ooi_ann is not None:
@@ -233,29 +438,44 @@ class ANNResource(object):
 
     def on_post(self, req, resp):
         try:
-            payload_json_buf = req.bounded_stream
-            payload_json = json.load(payload_json_buf)
-
-            neighbors = self.nn_from_payload(payload_json)
-            incl_dist = bool(payload_json.get('incl_dist')) or False
-            incl_score = bool(payload_json.get('incl_score')) or False
-            recs = [n.to_dict(incl_dist, incl_score) for n in neighbors]
-
-            res = {
-                'recs': recs,
-                'id_type': '-',
-            }
+            try:
+                payload_json = ujson.loads(req.bounded_stream.read())
+            except ValueError as e:
+                raise InvalidPayloadError(f'Malformed JSON: {e}')
+            opts = self.parse_query_opts(payload_json)
+
+            if 'ids' in payload_json or 'embs' in payload_json:
+                neighbors_l = self.nn_from_payload_batch(payload_json, opts)
+                recs = [select_rec_keys(neighbors,
+                                        opts.incl_dist, opts.incl_score)
+                        for neighbors in neighbors_l]
+            else:
+                neighbors = self.nn_from_payload(payload_json, opts)
+                recs = select_rec_keys(neighbors,
+                                       opts.incl_dist, opts.incl_score)
+        except QueryNotFoundError as e:
+            raise falcon.HTTPNotFound(description=str(e))
+        except DynamoValidationError as e:
+            raise falcon.HTTPBadRequest('Invalid query id', str(e))
+        except DynamoLookupError as e:
+            logger.warning('[%s] OOI lookup failed: %s', self.name, e)
+            raise falcon.HTTPServiceUnavailable(
+                title='OOI lookup failed', description=str(e),
+                retry_after=1)
+        except InvalidPayloadError as e:
+            raise falcon.HTTPBadRequest('Invalid payload', str(e))
+        except Exception:
+            logger.exception('[%s] Query failed', self.name)
+            raise falcon.HTTPInternalServerError(
+                'Internal server error', 'Query failed')
+
+        res = {
+            'recs': recs,
+            'id_type': '-',
+        }
 
-            resp.body = json.dumps(res)
-            resp.status = falcon.HTTP_200
-        except Exception as e:
-            # resp.body = json.dumps(
-            #     {'Error': f'An internal server error has occurred:\n{e}'})
-            # resp.status = falcon.HTTP_500
-            print(e)
-            # Return empty response with 200
-            resp.body = json.dumps([])
-            resp.status = falcon.HTTP_200
+        resp.body = ujson.dumps(res, double_precision=UJSON_DOUBLE_PRECISION)
+        resp.status = falcon.HTTP_200
 
     def on_get(self, req, resp):
         """Retrieve vector for given id
@@ -263,6 +483,9 @@ class ANNResource(object):
         If not (item is not active or something), try grabbing from dynamo.
         TODO:
         Finally, if desired, calculate the cold embedding somehow
+
+        Responds with the raw float32 buffer if the client accepts
+        `application/octet-stream`, otherwise with a JSON list
         """
 
         q_id = req.params['id']
@@ -273,21 +496,79 @@ class ANNResource(object):
             resp.status = falcon.HTTP_200
         else:
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps(q_emb)
+            if OCTET_STREAM in (req.accept or ''):
+                resp.data = np.asarray(q_emb, dtype=np.float32).tobytes()
+                resp.content_type = OCTET_STREAM
+            else:
+                if isinstance(q_emb, np.ndarray):
+                    q_emb = q_emb.tolist()
+                # `json` writes round-trip reprs, so the vector
+                # survives small components exactly
+                resp.body = json.dumps(q_emb)
 
     def set_fallback(self, fallback_parent: 'ANNResource'):
         self.fallback_parent = fallback_parent
 
     def tojson(self):
+        loaded = self.loaded
         return {
             'path_tar': self.path_tar,
-            'ann_meta': self.ann_meta_d,
+            'ann_meta': loaded.ann_meta_d,
             'ts_read': self.ts_read_utc.isoformat(),
-            'n_ids': len(self.ids),
-            'head5_ids': self.ids[:5],
+            'n_ids': len(loaded.ids),
+            'head5_ids': loaded.ids[:5].tolist(),
         }
 
 
+def validate_id(q_id):
+    """Raises `InvalidPayloadError` unless `q_id` can be an index id"""
+    if not isinstance(q_id, (str, int)) or isinstance(q_id, bool):
+        raise InvalidPayloadError('Query ids must be strings or integers')
+
+
+def map_native_threads(fn, l: List) -> List:
+    """Maps `fn` over `l` on native (OS) threads
+
+    ANNOY releases the GIL while searching, so this parallelizes the
+    searches across cores. Under gevent workers (`gunicorn -k gevent`)
+    `threading` is monkey-patched and executor threads would just be
+    greenlets blocking the hub, so use the hub's native threadpool.
+    `fn` must then not touch gevent primitives (patched locks, sockets)
+    as they aren't safe across native threads.
+    """
+    if gevent_monkey is not None \
+            and gevent_monkey.is_module_patched('threading'):
+        return list(get_hub().threadpool.map(fn, l))
+    return list(query_pool.map(fn, l))
+
+
+def score_to_dist(score: float) -> float:
+    """Inverse of the angular score (`score = 1 - dist / 2`)"""
+    return 2. * (1. - score)
+
+
+def truncate_by_dist(recs: List[Dict], dist_thresh: float) -> List[Dict]:
+    """Keeps recs with `dist < dist_thresh` (i.e. `score > thresh_score`)
+
+    ANNOY returns neighbors sorted by distance,
+        so stop at the first rec over the threshold
+    """
+    for i, r in enumerate(recs):
+        if r['dist'] >= dist_thresh:
+            return recs[:i]
+    return recs
+
+
+def select_rec_keys(recs: List[Dict], incl_dist=True, incl_score=True
+                    ) -> List[Dict]:
+    """Drops `dist`/`score` from rec dicts unless requested"""
+    keys = ('id',) + (('dist',) if incl_dist else ()) \
+        + (('score',) if incl_score else ())
+    if not recs or len(recs[0]) == len(keys):
+        return recs
+    return [{key: r[key] for key in keys} for r in recs]
+
+
 def dist_to_score(l, score_thresh=float('-inf')):
     """
         Adds a key 'score' to a list of dictionaries with distance
@@ -304,7 +585,9 @@ def dist_to_score(l, score_thresh=float('-inf')):
     if score_thresh is False:
         score_thresh = float('-inf')
 
-    return [{'score': (1. - d['distance'] / 2.), **d}
-            for d in l
-            if (1. - d['distance'] / 2.) > score_thresh
+    dists = np.fromiter((d['distance'] for d in l),
+                        dtype=np.float64, count=len(l))
+    scores = 1. - dists * 0.5
+    return [{'score': float(scores[i]), **l[i]}
+            for i in np.nonzero(scores > score_thresh)[0]
             ]
@@ -1,7 +1,9 @@
 import falcon
-from .ann import ANNResource, dist_to_score
+from .ann import (
+    ANNResource, dist_to_score, select_rec_keys, score_to_dist,
+    truncate_by_dist, UJSON_DOUBLE_PRECISION)
 from ..io import needs_reload, load_via_tar, load_index, get_dynamo_emb
-import json
+import ujson
 from typing import List, Dict
 from distutils.util import strtobool
 
@@ -43,24 +45,27 @@ class CrossANNResource(object):
 
             neighbors = self.ann_resources_d[c_name].nn_from_emb(
                 q_emb, k,
-                incl_dist=include_distances
+                incl_dist=include_distances,
+                incl_score=incl_score,
             )
 
             if thresh_score:
-                neighbors = [n for n in neighbors if n.score > thresh_score]
+                neighbors = truncate_by_dist(
+                    neighbors, score_to_dist(thresh_score))
 
-            recs = [n.to_dict(incl_dist, incl_score) for n in neighbors]
+            recs = select_rec_keys(neighbors, incl_dist, incl_score)
 
             res = {
                 'recs': recs,
                 'id_type': '-',
             }
 
-            resp.body = json.dumps(res)
+            resp.body = ujson.dumps(
+                res, double_precision=UJSON_DOUBLE_PRECISION)
             resp.status = falcon.HTTP_200
 
         except ValueError:
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps([])
+            resp.body = ujson.dumps([])
 
 
@@ -1,6 +1,6 @@
 import falcon
 from .ann import ANNResource
-import json
+import ujson
 import os
 from time import sleep
 
@@ -11,7 +11,7 @@ class ANNHealthcheckResource(object):
         self.ann_resource = ann_resource
 
     def on_get(self, req, resp):
-        resp.body = json.dumps(self.ann_resource.tojson())
+        resp.body = ujson.dumps(self.ann_resource.tojson())
         resp.status = falcon.HTTP_200
 
 
@@ -21,7 +21,7 @@ class HealthcheckResource(object):
         self.names = names
 
     def on_get(self, req, resp):
-        resp.body = json.dumps(self.names)
+        resp.body = ujson.dumps(self.names)
         resp.status = falcon.HTTP_200
 
 
@@ -47,7 +47,7 @@ class TmpSpaceResource(object):
 
         size_mb = int(get_size('/tmp') / 1e6)
 
-        resp.body = json.dumps(size_mb)
+        resp.body = ujson.dumps(size_mb)
         resp.status = falcon.HTTP_200
 
 
@@ -3,6 +3,9 @@ from .ann import ANNResource
 import json
 from typing import List, Dict
 import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class ScoringResource(object):
@@ -28,7 +31,7 @@ class ScoringResource(object):
 
             payload_json_buf = req.bounded_stream
             payload_json = json.load(payload_json_buf)
-            print(payload_json)
+            logger.debug('Scoring payload: %s', payload_json)
 
             ids_1 = payload_json.get('ids_1')
             catalog_1 = payload_json.get('catalog_1')
@@ -48,8 +51,10 @@ class ScoringResource(object):
             cos_arr = dot_arr / norms_1[:, None] / norms_2[None, :]
 
             dists_struct = dict(zip(
-                ids_1, map(lambda x: dict(zip(ids_2, x)), cos_arr)))
+                ids_1, map(lambda x: dict(zip(ids_2, x)), cos_arr.tolist())))
 
+            # `json` keeps full (round-trip) precision of the scores
+            # and stringifies non-str ids (ex. N-keyed ooi tables)
             resp.body = json.dumps(dists_struct)
             resp.status = falcon.HTTP_200
 
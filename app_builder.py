@@ -1,6 +1,5 @@
 import falcon
 from typing import Dict, Union
-import boto3
 import s3fs
 import os
 from pathlib import Path
@@ -8,12 +7,14 @@ from apscheduler.schedulers.background import BackgroundScheduler
 import logging
 try:
     from .app.resources import *
-    from .app.io import load_fallback_map
+    from .app.io import load_fallback_map, dynamodb, dynamo_emb_cache
 except ImportError:
     from app.resources import *
-    from app.io import load_fallback_map
+    from app.io import load_fallback_map, dynamodb, dynamo_emb_cache
 
+# Library modules only create loggers; configure output at the entrypoint
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 S3_URI_PREFIX = 's3://'
 
@@ -21,7 +22,6 @@ S3_URI_PREFIX = 's3://'
 PathType = Union[Path, str]
 
 s3 = s3fs.S3FileSystem()
-dynamodb = boto3.resource('dynamodb')
 
 
 def build_single_app(path_tar: PathType):
@@ -70,18 +70,21 @@ def build_many_app(path_ann_dir: PathType,
     else:
         ann_keys = [str(p) for p in Path(path_ann_dir).glob('**/*.tar*')]
 
-    logging.info(f'{len(ann_keys)} ann indexes detected')
+    logger.info('%s ann indexes detected', len(ann_keys))
 
     ooi_dynamo_table = None
     ooi_ann_name = None
     if ooi_table_name:
         dynamo_tables = {t.name for t in dynamodb.tables.all()}
         if ooi_table_name in dynamo_tables:
-            logging.info(f'Using {ooi_table_name} dynamo table for OOI lookup')
+            logger.info('Using %s dynamo table for OOI lookup', ooi_table_name)
             ooi_dynamo_table = dynamodb.Table(ooi_table_name)
+            if check_reload_interval > 0:
+                # Cached OOI embeddings go stale as fast as the indexes
+                dynamo_emb_cache.ttl = check_reload_interval
         else:
-            logging.info(f'Using {ooi_table_name} ANN (if exists) '
-                         f'for OOI lookup ')
+            logger.info('Using %s ANN (if exists) for OOI lookup',
+                        ooi_table_name)
             ooi_ann_name = ooi_table_name
 
     app.req_options.auto_parse_form_urlencoded = True
@@ -113,26 +116,26 @@ def build_many_app(path_ann_dir: PathType,
 
     ann_name_l = [falcon.uri.encode(n) for n in ann_d.keys()]
 
-    logging.info('***Done loading all indexes***')
+    logger.info('***Done loading all indexes***')
 
     if ooi_ann_name:
         # Linking OOI ann
         # (if the query is OOI for an ann, look at this other ann for the emb)
-        logging.info('Linking ooi_ann to resources...')
+        logger.info('Linking ooi_ann to resources...')
         for name, ann_r in ann_d.items():
             if name != ooi_ann_name:
                 ann_r.ooi_ann = ann_d[ooi_ann_name]
-        logging.info('... done linking ooi_ann_name')
+        logger.info('... done linking ooi_ann_name')
 
     if path_fallback_map:
         # Linking fallbacks
-        logging.info('Linking fallback resources...')
+        logger.info('Linking fallback resources...')
         # TODO: should check that there are no loops in fallback map
         fallback_map = load_fallback_map(path_fallback_map)
         for child, parent in fallback_map.items():
             if child in ann_d:
                 ann_d[child].set_fallback(ann_d[parent])
-        logging.info('... done linking fallbacks')
+        logger.info('... done linking fallbacks')
 
     cross_r = CrossANNResource(list(ann_d.values()),
                                fallback_dynamo_table=ooi_dynamo_table)
@@ -2,4 +2,4 @@
 
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
-${DIR}/../run.sh ${DIR}/fixtures/
\ No newline at end of file
+${DIR}/../run.sh ${DIR}/fixtures/ "" ${DIR}/fixtures/fallback_map.json
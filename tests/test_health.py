@@ -1,5 +1,6 @@
 import requests
 import json
+import struct
 
 ENDPOINT = 'http://localhost:8000'
 
@@ -67,6 +68,20 @@ def test_query_distance_score_thresh_score():
     assert r.status_code == 200
 
 
+def test_query_thresh_score_results():
+
+    payload = {'id': '0', 'k': 10, 'thresh_score': 0.4,
+               'incl_dist': True, 'incl_score': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    recs = json.loads(r.content)['recs']
+    assert len(recs) <= 10
+    # `thresh_score` is applied as the distance cutoff `2 * (1 - 0.4)`
+    assert all(n['score'] > 0.4 for n in recs)
+    assert all(n['dist'] < 2 * (1 - 0.4) for n in recs)
+
+
 def test_cross_query():
 
     r = requests.get(
@@ -124,3 +139,107 @@ def test_cross_query4():
 
     assert r.status_code == 200
 
+
+def test_query_batch():
+
+    payload = {'ids': ['0', '1', '2'], 'k': 10, 'incl_score': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    recs_l = json.loads(r.content)['recs']
+    assert len(recs_l) == 3
+    for q_id, recs in zip(payload['ids'], recs_l):
+        assert len(recs) == 10
+        assert q_id not in {n['id'] for n in recs}
+
+
+def test_query_batch_embs():
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=0')
+    assert r.status_code == 200
+    emb = json.loads(r.content)
+
+    payload = {'embs': [emb, emb], 'k': 5}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    recs_l = json.loads(r.content)['recs']
+    assert len(recs_l) == 2
+    assert recs_l[0] == recs_l[1]
+    assert len(recs_l[0]) == 5
+    # The item's own vector is its nearest neighbor
+    assert recs_l[0][0]['id'] == '0'
+
+
+def test_query_invalid_payload():
+
+    payload = {'id': '0'}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 400
+
+
+def test_get_vector_octet_stream():
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=0',
+                     headers={'Accept': 'application/octet-stream'})
+    assert r.status_code == 200
+    assert len(r.content) == 40 * 4  # float32 vector of `N_DIM` (40)
+
+
+def test_get_vector_json_round_trips():
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=0')
+    assert r.status_code == 200
+    emb = json.loads(r.content)
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=0',
+                     headers={'Accept': 'application/octet-stream'})
+    # JSON floats lose no digits of the float32 components
+    assert emb == list(struct.unpack('40f', r.content))
+
+
+def test_query_invalid_emb():
+
+    payload = {'emb': [1, 2], 'k': 2}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 400
+
+
+def test_query_fallback_thresh_score():
+    # run_test.sh links test_ann1 -> test_ann2 (fixtures/fallback_map.json)
+    def query(ann_name, **payload):
+        r = requests.post(ENDPOINT + f'/ann/{ann_name}/query',
+                          json=dict(payload, id='0', incl_score=True))
+        assert r.status_code == 200
+        return json.loads(r.content)['recs']
+
+    k = 99
+    # All 99 other items: enough neighbors not to fall back
+    child = query('test_ann1', k=k)
+    # Halfway between two neighbors so float rounding can't flip either
+    thresh_score = (child[49]['score'] + child[50]['score']) / 2
+    # Only the first 50 pass the threshold, the parent tops up the rest
+    child_ids = [n['id'] for n in child[:50]]
+    # All of the parent's neighbors passing the threshold
+    parent_ids = [n['id'] for n in
+                  query('test_ann2', k=k, thresh_score=thresh_score)]
+    parent_ids_unseen = [i for i in parent_ids if i not in set(child_ids)]
+
+    recs = query('test_ann1', k=k, thresh_score=thresh_score)
+    rec_ids = [n['id'] for n in recs]
+    # Parent neighbors the child already returned don't eat into `k`
+    assert len(rec_ids) == min(k, len(child_ids) + len(parent_ids_unseen))
+    # Child neighbors cut by the threshold aren't hidden from the parent
+    assert rec_ids == (child_ids + parent_ids_unseen)[:k]
+    assert len(set(rec_ids)) == len(rec_ids)
+    assert all(n['score'] > thresh_score for n in recs)
+
+
+def test_query_non_numeric_emb():
+
+    payload = {'emb': ['a'] * 40, 'k': 2}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 400
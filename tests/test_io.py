@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pytest
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from app import io as ann_io  # noqa: E402
+
+ID_KEY = 'variant_id'
+N_DIM = 4
+
+
+class StubTable(object):
+    name = 'test-repr-table'
+    key_schema = [{'AttributeName': ID_KEY, 'KeyType': 'HASH'}]
+
+
+class StubDynamo(object):
+    """Replays canned `batch_get_item` responses (or raises canned
+    exceptions) and records requests
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        self.requests.append(
+            [k[ID_KEY] for k in RequestItems[StubTable.name]['Keys']])
+        res = self.responses.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+def item(variant_id):
+    emb = np.full(N_DIM, float(variant_id), dtype=np.float32)
+    return {ID_KEY: variant_id, ann_io.DYNAMO_KEY: Binary(emb.tobytes())}
+
+
+def response(ids_found=(), ids_unprocessed=()):
+    res = {'Responses': {StubTable.name: [item(i) for i in ids_found]}}
+    if ids_unprocessed:
+        res['UnprocessedKeys'] = {StubTable.name: {
+            'Keys': [{ID_KEY: i} for i in ids_unprocessed]}}
+    return res
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ann_io.dynamo_emb_cache.clear()
+    sleeps = []
+    monkeypatch.setattr(ann_io, 'sleep', sleeps.append)
+    yield sleeps
+    ann_io.dynamo_emb_cache.clear()
+
+
+def test_get_dynamo_embs_retries_unprocessed(monkeypatch, sleeps):
+    stub = StubDynamo([
+        response(ids_found=['1'], ids_unprocessed=['2']),
+        response(ids_found=['2']),
+    ])
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    embs = ann_io.get_dynamo_embs(StubTable(), ['1', '2', '1'])
+
+    assert stub.requests == [['1', '2'], ['2']]
+    assert sleeps == [ann_io.DYNAMO_BACKOFF_BASE]
+    assert embs['2'].tolist() == [2.] * N_DIM
+
+
+def test_get_dynamo_embs_gives_up_without_final_sleep(monkeypatch, sleeps):
+    stub = StubDynamo([response(ids_unprocessed=['1'])] * 3
+                      + [response(ids_found=['1'])])
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    with pytest.raises(ann_io.DynamoLookupError):
+        ann_io.get_dynamo_embs(StubTable(), ['1'], max_retries=2)
+
+    assert len(stub.requests) == 3
+    assert len(sleeps) == 2
+    # Throttled keys aren't cached as missing
+    assert ann_io.get_dynamo_emb(StubTable(), '1') is not None
+    assert len(stub.requests) == 4
+
+
+def test_get_dynamo_embs_caches_hits_and_misses(monkeypatch, sleeps):
+    stub = StubDynamo([response(ids_found=['1'])])
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    assert set(ann_io.get_dynamo_embs(StubTable(), ['1', '2'])) == {'1'}
+    # Served from the cache: no more round-trips
+    assert set(ann_io.get_dynamo_embs(StubTable(), ['1', '2'])) == {'1'}
+    assert ann_io.get_dynamo_emb(StubTable(), '2') is None
+    assert stub.requests == [['1', '2']]
+
+
+def test_get_dynamo_embs_timeout_is_lookup_error(monkeypatch, sleeps):
+    stub = StubDynamo([ReadTimeoutError(endpoint_url='https://dynamo')] * 2)
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    with pytest.raises(ann_io.DynamoLookupError):
+        ann_io.get_dynamo_embs(StubTable(), ['1'])
+    assert ann_io.get_dynamo_emb(StubTable(), '1') is None
+
+
+def test_get_dynamo_embs_validation_error(monkeypatch, sleeps):
+    error = ClientError(
+        {'Error': {'Code': 'ValidationException',
+                   'Message': 'key element does not match the schema'}},
+        'BatchGetItem')
+    stub = StubDynamo([error])
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    with pytest.raises(ann_io.DynamoValidationError):
+        ann_io.get_dynamo_embs(StubTable(), [1])
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = ann_io.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1  # 'b' is now least recently used
+    cache['c'] = 3
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_expires_entries():
+    clock = FakeClock()
+    cache = ann_io.LRUCache(2, ttl=10, timer=clock)
+    cache['a'] = 1
+    cache.set('b', 2, ttl=1)
+
+    clock.now = 1
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    clock.now = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_get_dynamo_embs_refetches_expired_miss(monkeypatch, sleeps):
+    clock = FakeClock()
+    monkeypatch.setattr(ann_io.dynamo_emb_cache, 'timer', clock)
+    stub = StubDynamo([response(), response(ids_found=['1'])])
+    monkeypatch.setattr(ann_io, 'dynamodb', stub)
+
+    assert ann_io.get_dynamo_emb(StubTable(), '1') is None
+    assert ann_io.get_dynamo_emb(StubTable(), '1') is None
+    assert len(stub.requests) == 1
+    # Written to the table after the miss was cached
+    clock.now = ann_io.DYNAMO_MISS_TTL
+    assert ann_io.get_dynamo_emb(StubTable(), '1') is not None
+    assert len(stub.requests) == 2